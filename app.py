@@ -9,6 +9,19 @@ import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from datetime import datetime
 import json
+import gzip
+import zlib
+import glob
+import queue
+import random
+import threading
+import atexit
+import time
+import hashlib
+import itertools
+import secrets
+import socket
+import click
 
 app = Flask(__name__)
 
@@ -21,14 +34,24 @@ if os.environ.get('NETLIFY'):
     db_path = os.environ.get('DATABASE_URL', 'sqlite:////tmp/medpro.db')
     app.config['SQLALCHEMY_DATABASE_URI'] = db_path
     app.config['UPLOAD_FOLDER'] = '/tmp/uploads'
+    app.config['PREDICTION_LOG_DIR'] = os.environ.get('PREDICTION_LOG_DIR', '/tmp/logs/predictions')
 else:
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-super-secret-key-change-this-in-production')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///medpro.db')
     app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.config['PREDICTION_LOG_DIR'] = os.environ.get('PREDICTION_LOG_DIR', 'logs/predictions')
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# Prediction audit log: records are queued in memory and written by a background thread
+app.config['PREDICTION_LOG_QUEUE_SIZE'] = int(os.environ.get('PREDICTION_LOG_QUEUE_SIZE', 10000))
+app.config['PREDICTION_LOG_BATCH_SIZE'] = int(os.environ.get('PREDICTION_LOG_BATCH_SIZE', 200))
+app.config['PREDICTION_LOG_SEGMENT_BYTES'] = int(os.environ.get('PREDICTION_LOG_SEGMENT_BYTES', 4 * 1024 * 1024))
+app.config['PREDICTION_LOG_SEGMENT_SECONDS'] = int(os.environ.get('PREDICTION_LOG_SEGMENT_SECONDS', 3600))
+# Fraction of records kept once the queue is past its high-water mark
+app.config['PREDICTION_LOG_SAMPLE_RATE'] = float(os.environ.get('PREDICTION_LOG_SAMPLE_RATE', 0.1))
+
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 db = SQLAlchemy(app)
@@ -123,6 +146,394 @@ def load_and_train_model():
 
 clf_model = load_and_train_model()
 
+# Symptom co-occurrence index for next-best-symptom suggestions
+# Bits per byte, used to count set bits in the packed arrays without unpacking them
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+class SymptomIndex:
+    """Bit-packed symptom x disease index built once from Training.csv.
+
+    ``symptom_bits[s]`` is the set of diseases that ever present symptom ``s``
+    and ``disease_bits[d]`` is the set of symptoms seen with disease ``d``, both
+    packed with ``np.packbits``. Queries are intersections and popcounts only,
+    so the model never has to run.
+    """
+
+    def __init__(self, matrix):
+        # matrix: boolean array of shape (len(disease), len(l1))
+        self.symptom_bits = np.packbits(matrix.T, axis=1)
+        self.disease_bits = np.packbits(matrix, axis=1)
+        self.symptom_totals = _POPCOUNT[self.disease_bits].sum(axis=1, dtype=np.int64)
+        self.symptom_position = {symptom: i for i, symptom in enumerate(l1)}
+
+    def query_bits(self, symptoms):
+        vector = np.zeros(len(l1), dtype=bool)
+        for symptom in symptoms:
+            if symptom in self.symptom_position:
+                vector[self.symptom_position[symptom]] = True
+        return vector, np.packbits(vector)
+
+    def candidates(self, symptoms, absent=()):
+        """Return every candidate disease, best first, as ``(disease index, matched count)`` pairs.
+
+        Diseases presenting any of the ``absent`` symptoms are ruled out.
+        """
+        vector, packed = self.query_bits(symptoms)
+        if not vector.any():
+            return []
+        _, absent_packed = self.query_bits(absent)
+        allowed = ~(self.disease_bits & absent_packed).any(axis=1)
+        # Diseases presenting every selected symptom
+        common = np.bitwise_and.reduce(self.symptom_bits[vector], axis=0)
+        members = np.unpackbits(common)[:len(disease)].astype(bool) & allowed
+        matched = _POPCOUNT[self.disease_bits & packed].sum(axis=1, dtype=np.int64)
+        if not members.any():
+            # No exact intersection, fall back to the best partial overlap
+            members = (matched > 0) & allowed
+        extra = self.symptom_totals - matched
+        order = np.lexsort((extra, -matched))
+        return [(int(d), int(matched[d])) for d in order if members[d]]
+
+    def next_symptoms(self, symptoms, candidate_ids, limit=5):
+        """Rank unselected symptoms by how evenly they split the candidates."""
+        if len(candidate_ids) < 2:
+            return []
+        vector, _ = self.query_bits(symptoms)
+        rows = np.unpackbits(self.disease_bits[candidate_ids], axis=1)[:, :len(l1)]
+        counts = rows.sum(axis=0, dtype=np.int64)
+        total = len(candidate_ids)
+        split = np.minimum(counts, total - counts)
+        split[vector] = 0
+        order = np.lexsort((-counts, -split))
+        return [(int(s), int(counts[s])) for s in order[:limit] if split[s] > 0]
+
+def build_symptom_index():
+    try:
+        df = pd.read_csv("Training.csv")
+        df['prognosis'] = df['prognosis'].str.strip()
+        mapping = {disease_name: i for i, disease_name in enumerate(disease)}
+        df['prognosis'] = df['prognosis'].map(mapping)
+        df = df.dropna(subset=['prognosis'])
+        presence = df[l1].astype(bool).groupby(df['prognosis'].astype(int)).any()
+        presence = presence.reindex(range(len(disease)), fill_value=False)
+        return SymptomIndex(presence.to_numpy(dtype=bool))
+    except Exception as e:
+        print(f"Error building symptom index: {e}")
+        return None
+
+symptom_index = build_symptom_index()
+
+def get_model_version():
+    """Identify the trained model by its estimator settings and training data"""
+    try:
+        with open("Training.csv", 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:8]
+    except OSError:
+        digest = 'unknown'
+    return os.environ.get('MODEL_VERSION', f"rf-100-{digest}")
+
+MODEL_VERSION = get_model_version()
+
+# Prediction audit log
+_STOP = object()
+
+class PredictionLogger:
+    """Non-blocking audit log for symptom checker predictions.
+
+    ``log`` only puts the record on an in-memory queue. A background thread
+    writes queued records in batches to gzip-compressed JSONL segments, which
+    are rotated by size and age. Once the queue is past its high-water mark
+    only a sample of records is kept (each carries a ``weight`` so reports stay
+    unbiased) and when it is full records are dropped instead of blocking.
+
+    Every process writes its own segments (host, pid, a sequence number and a
+    random suffix are in the file name), so several gunicorn workers or
+    containers can share one log directory. The writer thread is
+    started lazily per pid, which also covers workers forked after import. A
+    forked child never touches a segment it inherited from its parent.
+    """
+
+    def __init__(self, log_dir, queue_size=10000, batch_size=200, segment_bytes=4 * 1024 * 1024,
+                 segment_seconds=3600, sample_rate=0.1, high_water=0.8, flush_interval=1.0):
+        self.log_dir = log_dir
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.sample_rate = sample_rate
+        self.high_water_mark = int(queue_size * high_water)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.sampled_out = 0
+        self._reported = {'dropped': 0, 'sampled_out': 0}
+        self._stats_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._segment = None
+        self._sequence = itertools.count()
+        # Keeps names unique across containers that share a volume and reuse pids
+        self._host = ''.join(c if c.isalnum() or c in '-_' else '_' for c in socket.gethostname()) or 'host'
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork_in_child)
+
+    def _after_fork_in_child(self):
+        # Locks may have been held by the parent's threads at fork time
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        segment = self._segment
+        self._segment = None
+        if segment is None:
+            return
+        # The parent keeps writing this segment. Point the child's copy of the fd
+        # at /dev/null so the inherited file objects can't flush or append a gzip
+        # trailer to it when they are finalized.
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            try:
+                os.dup2(devnull, segment['file'].fileno())
+            finally:
+                os.close(devnull)
+        except (OSError, ValueError):
+            # Already closed by a rotation in the parent
+            pass
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._segment = None
+            self._sequence = itertools.count()
+            # A forked worker starts its own counters, the parent reports its own
+            with self._stats_lock:
+                self.dropped = 0
+                self.sampled_out = 0
+            self._reported = {'dropped': 0, 'sampled_out': 0}
+            self._thread = threading.Thread(target=self._run, name='prediction-logger', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def log(self, **record):
+        """Queue a record for writing, returns False if it was sampled out or dropped"""
+        self._ensure_started()
+        weight = 1.0
+        if self._queue.qsize() >= self.high_water_mark:
+            if random.random() >= self.sample_rate:
+                with self._stats_lock:
+                    self.sampled_out += 1
+                return False
+            weight = 1.0 / self.sample_rate
+        record.setdefault('timestamp', datetime.utcnow().isoformat())
+        record['weight'] = weight
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def close(self, timeout=5.0):
+        """Flush queued records and finish the current segment"""
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        self._pid = None
+
+    def _run(self):
+        while True:
+            batch = []
+            stop = False
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                while True:
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            if stop:
+                # Exit even if the final flush fails, so close() never waits out its timeout
+                try:
+                    if batch:
+                        self._write(batch)
+                    self._write_stats()
+                    self._rotate()
+                except Exception as e:
+                    print(f"Error closing prediction log: {e}")
+                return
+
+            try:
+                if batch:
+                    self._write(batch)
+                self._write_stats()
+                if self._segment and (self._segment['file'].tell() >= self.segment_bytes or
+                                      time.time() - self._segment['opened'] >= self.segment_seconds):
+                    self._rotate()
+            except Exception as e:
+                print(f"Error writing prediction log: {e}")
+
+    def _write(self, batch):
+        if self._segment is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            path, raw = self._open_segment()
+            self._segment = {
+                'path': path,
+                'file': raw,
+                'gzip': gzip.GzipFile(fileobj=raw, mode='wb'),
+                'opened': time.time()
+            }
+        data = ''.join(json.dumps(record) + '\n' for record in batch)
+        self._segment['gzip'].write(data.encode('utf-8'))
+        # Sync flush so a crash loses at most the batch in flight
+        self._segment['gzip'].flush()
+
+    def _write_stats(self):
+        # Records that never reached the queue are only visible through these
+        with self._stats_lock:
+            dropped = self.dropped - self._reported['dropped']
+            sampled_out = self.sampled_out - self._reported['sampled_out']
+        if not dropped and not sampled_out:
+            return
+        self._write([{
+            'type': 'stats',
+            'timestamp': datetime.utcnow().isoformat(),
+            'host': self._host,
+            'pid': os.getpid(),
+            'dropped': dropped,
+            'sampled_out': sampled_out
+        }])
+        self._reported['dropped'] += dropped
+        self._reported['sampled_out'] += sampled_out
+
+    def _open_segment(self):
+        # Never reuse the name of an earlier segment, finished or not
+        while True:
+            name = (f"predictions-{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}-{self._host}-"
+                    f"{os.getpid()}-{next(self._sequence):06d}-{secrets.token_hex(4)}.jsonl.gz")
+            path = os.path.join(self.log_dir, name)
+            if os.path.exists(path):
+                continue
+            try:
+                return path, open(path + '.part', 'xb')
+            except FileExistsError:
+                continue
+
+    def _rotate(self):
+        if self._segment is None:
+            return
+        self._segment['gzip'].close()
+        self._segment['file'].close()
+        os.replace(self._segment['path'] + '.part', self._segment['path'])
+        self._segment = None
+
+prediction_logger = PredictionLogger(
+    app.config['PREDICTION_LOG_DIR'],
+    queue_size=app.config['PREDICTION_LOG_QUEUE_SIZE'],
+    batch_size=app.config['PREDICTION_LOG_BATCH_SIZE'],
+    segment_bytes=app.config['PREDICTION_LOG_SEGMENT_BYTES'],
+    segment_seconds=app.config['PREDICTION_LOG_SEGMENT_SECONDS'],
+    sample_rate=app.config['PREDICTION_LOG_SAMPLE_RATE']
+)
+atexit.register(prediction_logger.close)
+
+def read_prediction_logs(log_dir):
+    """Yield records from finished and in-progress log segments"""
+    paths = sorted(glob.glob(os.path.join(log_dir, 'predictions-*.jsonl.gz')) +
+                   glob.glob(os.path.join(log_dir, 'predictions-*.jsonl.gz.part')))
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                remaining = f.read()
+        except OSError as e:
+            print(f"Skipping unreadable prediction log {path}: {e}")
+            continue
+        # Read every gzip member. decompressobj tolerates segments of live or
+        # crashed workers that end without a gzip trailer.
+        chunks = []
+        while remaining:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            try:
+                chunks.append(decompressor.decompress(remaining))
+            except zlib.error as e:
+                print(f"Skipping damaged data at the end of prediction log {path}: {e}")
+                break
+            if not decompressor.eof:
+                if not path.endswith('.part'):
+                    print(f"Prediction log {path} is truncated, its last records may be missing")
+                break
+            remaining = decompressor.unused_data
+        data = b''.join(chunks)
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+def aggregate_prediction_logs(log_dir):
+    """Build per-disease and per-symptom frequency reports from the log segments"""
+    diseases = {}
+    symptoms = {}
+    models = {}
+    latencies = []
+    total = 0.0
+    records = 0
+    dropped = 0
+    sampled_out = 0
+    for record in read_prediction_logs(log_dir):
+        if record.get('type') == 'stats':
+            dropped += record.get('dropped', 0)
+            sampled_out += record.get('sampled_out', 0)
+            continue
+        weight = record.get('weight', 1.0)
+        records += 1
+        total += weight
+        stats = diseases.setdefault(record.get('prediction'), {'count': 0.0, 'confidence': 0.0})
+        stats['count'] += weight
+        stats['confidence'] += weight * record.get('confidence', 0.0)
+        for symptom in record.get('symptoms', []):
+            symptoms[symptom] = symptoms.get(symptom, 0.0) + weight
+        models[record.get('model_version')] = models.get(record.get('model_version'), 0.0) + weight
+        if record.get('latency_ms') is not None:
+            latencies.append(record['latency_ms'])
+
+    return {
+        'records': records,
+        # Every prediction is either written or counted in a stats record
+        'predictions': records + dropped + sampled_out,
+        'dropped': dropped,
+        'sampled_out': sampled_out,
+        'latency_ms': {
+            'mean': round(float(np.mean(latencies)), 2) if latencies else None,
+            'p95': round(float(np.percentile(latencies, 95)), 2) if latencies else None
+        },
+        'model_versions': {k: round(v, 1) for k, v in models.items()},
+        'diseases': sorted([{
+            'disease': name,
+            'count': round(stats['count'], 1),
+            'share': round(stats['count'] / total * 100, 2),
+            'avg_confidence': round(stats['confidence'] / stats['count'], 2)
+        } for name, stats in diseases.items()], key=lambda d: d['count'], reverse=True),
+        'symptoms': sorted([{
+            'symptom': name,
+            'count': round(count, 1),
+            'share': round(count / total * 100, 2)
+        } for name, count in symptoms.items()], key=lambda s: s['count'], reverse=True)
+    }
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -293,10 +704,17 @@ def public_symptom_checker():
                 input_vector[index] = 1
         
         if clf_model:
+            started = time.perf_counter()
             prediction_proba = clf_model.predict_proba([input_vector])[0]
             prediction_index = clf_model.predict([input_vector])[0]
             prediction = disease[prediction_index]
             confidence = max(prediction_proba) * 100
+            prediction_logger.log(endpoint='public_symptom_checker',
+                                  symptoms=[s for s in symptoms if s in l1],
+                                  prediction=prediction,
+                                  confidence=round(float(confidence), 2),
+                                  model_version=MODEL_VERSION,
+                                  latency_ms=round((time.perf_counter() - started) * 1000, 2))
             
             return render_template('public_symptom_checker.html', 
                                 symptoms=l1, 
@@ -326,10 +744,17 @@ def predict():
                 input_vector[index] = 1
         
         if clf_model:
+            started = time.perf_counter()
             prediction_proba = clf_model.predict_proba([input_vector])[0]
             prediction_index = clf_model.predict([input_vector])[0]
             prediction = disease[prediction_index]
             confidence = max(prediction_proba) * 100
+            prediction_logger.log(endpoint='predict',
+                                  symptoms=[s for s in symptoms if s in l1],
+                                  prediction=prediction,
+                                  confidence=round(float(confidence), 2),
+                                  model_version=MODEL_VERSION,
+                                  latency_ms=round((time.perf_counter() - started) * 1000, 2))
             
             return render_template('predict.html', 
                                 symptoms=l1, 
@@ -341,6 +766,63 @@ def predict():
     
     return render_template('predict.html', symptoms=l1)
 
+@app.route('/api/next-symptom', methods=['GET', 'POST'])
+def next_symptom():
+    """Suggest the symptom that best narrows down the candidate diseases"""
+    if symptom_index is None:
+        return jsonify({'error': 'Symptom index not available'}), 503
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        symptoms = data.get('symptoms') or []
+        absent = data.get('absent') or []
+        k = data.get('k', 5)
+    else:
+        symptoms = []
+        for value in request.args.getlist('symptoms'):
+            symptoms.extend(value.split(','))
+        absent = []
+        for value in request.args.getlist('absent'):
+            absent.extend(value.split(','))
+        k = request.args.get('k', 5)
+
+    if not isinstance(symptoms, list) or not isinstance(absent, list):
+        return jsonify({'error': 'symptoms and absent must be lists'}), 400
+    try:
+        k = max(1, min(int(k), len(disease)))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({'error': 'k must be an integer'}), 400
+
+    symptoms = [s.strip() for s in symptoms if isinstance(s, str) and s.strip() in l1]
+    if not symptoms:
+        return jsonify({'error': 'Please select at least one known symptom'}), 400
+    absent = [s.strip() for s in absent
+              if isinstance(s, str) and s.strip() in l1 and s.strip() not in symptoms]
+
+    # Suggestions split the whole candidate set, k only trims what is displayed
+    candidates = symptom_index.candidates(symptoms, absent)
+    candidate_ids = [d for d, _ in candidates]
+    suggestions = symptom_index.next_symptoms(symptoms, candidate_ids)
+    return jsonify({
+        'symptoms': symptoms,
+        'absent': absent,
+        'total_candidates': len(candidates),
+        'candidates': [{
+            'disease': disease[d],
+            'matched': matched,
+            'total_symptoms': int(symptom_index.symptom_totals[d])
+        } for d, matched in candidates[:k]],
+        'next_symptoms': [{
+            'symptom': l1[s],
+            'present_in': count,
+            'absent_in': len(candidate_ids) - count
+        } for s, count in suggestions]
+    })
+
 @app.route('/appointment', methods=['GET', 'POST'])
 @login_required
 def appointment():
@@ -505,6 +987,31 @@ def debug_users():
         })
     return {'users': result, 'count': len(result)}
 
+@app.cli.command('prediction-report')
+@click.option('--log-dir', default=None, help='Directory with prediction log segments')
+@click.option('--top', default=20, show_default=True, help='Rows to show per report')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON')
+def prediction_report(log_dir, top, as_json):
+    """Aggregate prediction log segments into disease and symptom frequencies"""
+    report = aggregate_prediction_logs(log_dir or app.config['PREDICTION_LOG_DIR'])
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    click.echo(f"Records: {report['records']} of {report['predictions']} predictions")
+    click.echo(f"Not logged: {report['dropped']} dropped (queue full), {report['sampled_out']} sampled out (queue busy)")
+    click.echo(f"Latency: mean {report['latency_ms']['mean']} ms, p95 {report['latency_ms']['p95']} ms")
+    for version, count in report['model_versions'].items():
+        click.echo(f"Model {version}: {count}")
+
+    click.echo("\nDiseases:")
+    for row in report['diseases'][:top]:
+        click.echo(f"  {row['disease']:<45} {row['count']:>10} {row['share']:>6}%  avg confidence {row['avg_confidence']}%")
+
+    click.echo("\nSymptoms:")
+    for row in report['symptoms'][:top]:
+        click.echo(f"  {row['symptom']:<45} {row['count']:>10} {row['share']:>6}%")
+
 def create_tables():
     with app.app_context():
         db.create_all()
@@ -0,0 +1,60 @@
+// Ask the next symptom without re-running the prediction model
+document.addEventListener('DOMContentLoaded', function() {
+    const panel = document.getElementById('next-symptom-panel');
+    if (!panel) {
+        return;
+    }
+
+    const selected = panel.dataset.symptoms.split(',').filter(Boolean);
+    const absent = [];
+    const label = s => s.replace(/_/g, ' ').replace(/\b\w/g, c => c.toUpperCase());
+
+    const answerButton = function(text, className, onClick) {
+        const button = document.createElement('button');
+        button.type = 'button';
+        button.className = `btn btn-sm ${className}`;
+        button.textContent = text;
+        button.addEventListener('click', onClick);
+        return button;
+    };
+
+    const refresh = function() {
+        fetch(panel.dataset.endpoint, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({symptoms: selected, absent: absent, k: 5})
+        })
+        .then(response => response.json())
+        .then(data => {
+            const candidates = document.getElementById('next-symptom-candidates');
+            const question = document.getElementById('next-symptom-question');
+            const options = document.getElementById('next-symptom-options');
+            candidates.innerHTML = '';
+            options.innerHTML = '';
+            (data.candidates || []).forEach(c => {
+                const badge = document.createElement('span');
+                badge.className = 'badge bg-light text-dark border';
+                badge.textContent = `${c.disease} (${c.matched}/${selected.length})`;
+                candidates.appendChild(badge);
+            });
+            const next = data.next_symptoms || [];
+            question.textContent = next.length ? 'Do you also have any of these?' : '';
+            next.forEach(n => {
+                const group = document.createElement('div');
+                group.className = 'btn-group';
+                group.appendChild(answerButton(label(n.symptom), 'btn-outline-secondary disabled', function() {}));
+                group.appendChild(answerButton('Yes', 'btn-outline-success', function() {
+                    selected.push(n.symptom);
+                    refresh();
+                }));
+                group.appendChild(answerButton('No', 'btn-outline-danger', function() {
+                    absent.push(n.symptom);
+                    refresh();
+                }));
+                options.appendChild(group);
+            });
+        })
+        .catch(error => console.error('Next symptom lookup failed:', error));
+    };
+    refresh();
+});
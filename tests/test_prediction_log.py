@@ -0,0 +1,44 @@
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+import app
+
+
+RECORD = dict(endpoint='test', symptoms=['coma'], prediction='Malaria', confidence=50.0,
+              model_version='test', latency_ms=1.0)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+def test_fork_with_open_segment_keeps_parent_records(tmp_path):
+    logger = app.PredictionLogger(str(tmp_path), flush_interval=0.05)
+    for _ in range(30):
+        logger.log(**RECORD)
+    # Let the writer open a segment before forking
+    time.sleep(0.3)
+    assert logger._segment is not None
+
+    pid = os.fork()
+    if pid == 0:
+        logger.log(**RECORD)
+        logger.close()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    for _ in range(30):
+        logger.log(**RECORD)
+    logger.close()
+
+    assert app.aggregate_prediction_logs(str(tmp_path))['records'] == 61
+
+
+def test_read_concatenated_and_damaged_segments(tmp_path, capsys):
+    line = (json.dumps(RECORD) + '\n').encode('utf-8')
+    (tmp_path / 'predictions-a.jsonl.gz').write_bytes(gzip.compress(line) + gzip.compress(line * 2))
+    (tmp_path / 'predictions-b.jsonl.gz').write_bytes(gzip.compress(line) + b'not gzip data')
+
+    assert len(list(app.read_prediction_logs(str(tmp_path)))) == 4
+    assert 'predictions-b.jsonl.gz' in capsys.readouterr().out